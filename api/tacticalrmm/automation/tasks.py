@@ -55,7 +55,9 @@ def generate_agent_checks_by_location_task(location, mon_type, create_tasks=Fals
 @app.task
 # generates policy checks on all agent servers or workstations and optionally generate automated tasks
 def generate_all_agent_checks_task(mon_type, create_tasks=False):
-    for agent in Agent.objects.filter(monitoring_type=mon_type):
+    # stream the agents in chunks instead of loading the whole table at once
+    agents = Agent.objects.filter(monitoring_type=mon_type)
+    for agent in agents.iterator(chunk_size=500):
         agent.generate_checks_from_policies()
 
         if create_tasks:
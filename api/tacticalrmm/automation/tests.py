@@ -1,10 +1,16 @@
-from unittest.mock import patch
+from unittest.mock import patch, call, MagicMock, ANY
+from django.db.models import Count, QuerySet
 from tacticalrmm.test import TacticalTestCase
-from model_bakery import baker, seq
-from itertools import cycle
+from model_bakery import baker
 from agents.models import Agent
+from autotasks.models import AutomatedTask
+from checks.models import Check
+from clients.models import Client, Site
 from winupdate.models import WinUpdatePolicy
 
+from . import tasks
+from .models import Policy
+
 from .serializers import (
     PolicyTableSerializer,
     PolicySerializer,
@@ -15,39 +21,80 @@ from .serializers import (
     AutoTasksFieldSerializer,
 )
 
+# tasks queued with .delay by the views and model saves under test
+QUEUED_TASKS = (
+    "generate_agent_checks_from_policies_task",
+    "generate_agent_checks_task",
+    "generate_agent_checks_by_location_task",
+    "generate_all_agent_checks_task",
+    "run_win_policy_autotask_task",
+)
+
+
+def setUpModule():
+    # swap .delay for a mock once for the whole module, the tasks themselves
+    # are still called directly by the tests that check what they do
+    for name in QUEUED_TASKS:
+        getattr(tasks, name).delay = MagicMock()
+
+
+def tearDownModule():
+    for name in QUEUED_TASKS:
+        del getattr(tasks, name).delay
+
+
+def reset_queued_tasks():
+    for name in QUEUED_TASKS:
+        getattr(tasks, name).delay.reset_mock()
+
+
+def check_counts(agent_ids):
+    # returns {agent pk: number of checks} using a single query
+    return dict(
+        Agent.objects.filter(pk__in=agent_ids)
+        .annotate(checks=Count("agentchecks"))
+        .values_list("pk", "checks")
+    )
+
 
 class TestPolicyViews(TacticalTestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.setup_users()
+        cls.setup_coresettings()
+        cls.policy = baker.make("automation.Policy", active=True, enforced=False)
+        cls.policies = [cls.policy] + baker.make(
+            "automation.Policy", _quantity=2, _bulk_create=True
+        )
+        cls.site = baker.make("clients.Site")
+
+        # expected responses for the fixtures above, serialized once per class
+        cls.policies_data = PolicyTableSerializer(cls.policies, many=True).data
+        cls.policy_data = PolicySerializer(cls.policy).data
+
     def setUp(self):
-        self.authenticate()
-        self.setup_coresettings()
+        reset_queued_tasks()
+        self.login()
 
     def test_get_all_policies(self):
         url = "/automation/policies/"
 
-        policies = baker.make("automation.Policy", _quantity=3)
-        resp = self.client.get(url, format="json")
-        serializer = PolicyTableSerializer(policies, many=True)
+        resp = self.client.get(url)
 
         self.assertEqual(resp.status_code, 200)
-        self.assertEqual(resp.data, serializer.data)
-
-        self.check_not_authenticated("get", url)
+        self.assertEqual(resp.data, self.policies_data)
 
     def test_get_policy(self):
         # returns 404 for invalid policy pk
-        resp = self.client.get("/automation/policies/500/", format="json")
+        resp = self.client.get("/automation/policies/500/")
         self.assertEqual(resp.status_code, 404)
 
-        policy = baker.make("automation.Policy")
-        url = f"/automation/policies/{policy.pk}/"
+        url = f"/automation/policies/{self.policy.pk}/"
 
-        resp = self.client.get(url, format="json")
-        serializer = PolicySerializer(policy)
+        resp = self.client.get(url)
 
         self.assertEqual(resp.status_code, 200)
-        self.assertEqual(resp.data, serializer.data)
-
-        self.check_not_authenticated("get", url)
+        self.assertEqual(resp.data, self.policy_data)
 
     def test_add_policy(self):
         url = "/automation/policies/"
@@ -67,9 +114,11 @@ class TestPolicyViews(TacticalTestCase):
         self.assertEqual(resp.status_code, 400)
 
         # create policy with tasks and checks
-        policy = baker.make("automation.Policy")
+        policy = self.policy
         self.create_checks(policy=policy)
-        baker.make("autotasks.AutomatedTask", policy=policy, _quantity=3)
+        baker.make(
+            "autotasks.AutomatedTask", policy=policy, _quantity=3, _bulk_create=True
+        )
 
         # test copy tasks and checks to another policy
         data = {
@@ -85,15 +134,12 @@ class TestPolicyViews(TacticalTestCase):
         self.assertEqual(policy.autotasks.count(), 3)
         self.assertEqual(policy.policychecks.count(), 7)
 
-        self.check_not_authenticated("post", url)
-
-    @patch("automation.tasks.generate_agent_checks_from_policies_task.delay")
-    def test_update_policy(self, generate_agent_checks_from_policies_task):
+    def test_update_policy(self):
         # returns 404 for invalid policy pk
         resp = self.client.put("/automation/policies/500/", format="json")
         self.assertEqual(resp.status_code, 404)
 
-        policy = baker.make("automation.Policy", active=True, enforced=False)
+        policy = self.policy
         url = f"/automation/policies/{policy.pk}/"
 
         data = {
@@ -107,7 +153,7 @@ class TestPolicyViews(TacticalTestCase):
         self.assertEqual(resp.status_code, 200)
 
         # only called if active or enforced are updated
-        generate_agent_checks_from_policies_task.assert_not_called()
+        tasks.generate_agent_checks_from_policies_task.delay.assert_not_called()
 
         data = {
             "name": "Test Policy Update",
@@ -118,72 +164,70 @@ class TestPolicyViews(TacticalTestCase):
 
         resp = self.client.put(url, data, format="json")
         self.assertEqual(resp.status_code, 200)
-        generate_agent_checks_from_policies_task.assert_called_with(
+        tasks.generate_agent_checks_from_policies_task.delay.assert_called_with(
             policypk=policy.pk, create_tasks=True
         )
 
-        self.check_not_authenticated("put", url)
-
-    @patch("automation.tasks.generate_agent_checks_task.delay")
-    def test_delete_policy(self, generate_agent_checks_task):
+    def test_delete_policy(self):
         # returns 404 for invalid policy pk
-        resp = self.client.delete("/automation/policies/500/", format="json")
+        resp = self.client.delete("/automation/policies/500/")
         self.assertEqual(resp.status_code, 404)
 
         # setup data
-        policy = baker.make("automation.Policy")
-        site = baker.make("clients.Site")
-        agents = baker.make_recipe(
-            "agents.agent", site=site, policy=policy, _quantity=3
+        policy = self.policy
+        Agent.objects.bulk_create(
+            [
+                Agent(site=self.site, policy=policy, monitoring_type="server")
+                for _ in range(3)
+            ]
+        )
+        # the policy fk is cleared on delete so grab the pks beforehand
+        agent_pks = list(
+            Agent.objects.filter(policy=policy).values_list("pk", flat=True)
         )
         url = f"/automation/policies/{policy.pk}/"
 
-        resp = self.client.delete(url, format="json")
+        resp = self.client.delete(url)
         self.assertEqual(resp.status_code, 200)
 
-        generate_agent_checks_task.assert_called_with(
-            [agent.pk for agent in agents], create_tasks=True
+        tasks.generate_agent_checks_task.delay.assert_called_with(
+            agent_pks, create_tasks=True
         )
 
-        self.check_not_authenticated("delete", url)
-
     def test_get_all_policy_tasks(self):
         # create policy with tasks
-        policy = baker.make("automation.Policy")
-        tasks = baker.make("autotasks.AutomatedTask", policy=policy, _quantity=3)
+        policy = self.policy
+        policy_tasks = baker.make(
+            "autotasks.AutomatedTask", policy=policy, _quantity=3, _bulk_create=True
+        )
         url = f"/automation/{policy.pk}/policyautomatedtasks/"
 
-        resp = self.client.get(url, format="json")
-        serializer = AutoTasksFieldSerializer(tasks, many=True)
+        resp = self.client.get(url)
+        serializer = AutoTasksFieldSerializer(policy_tasks, many=True)
 
         self.assertEqual(resp.status_code, 200)
         self.assertEqual(resp.data, serializer.data)
         self.assertEqual(len(resp.data), 3)
 
-        self.check_not_authenticated("get", url)
-
     def test_get_all_policy_checks(self):
 
         # setup data
-        policy = baker.make("automation.Policy")
+        policy = self.policy
         checks = self.create_checks(policy=policy)
 
         url = f"/automation/{policy.pk}/policychecks/"
 
-        resp = self.client.get(url, format="json")
+        resp = self.client.get(url)
         serializer = PolicyCheckSerializer(checks, many=True)
 
         self.assertEqual(resp.status_code, 200)
         self.assertEqual(resp.data, serializer.data)
         self.assertEqual(len(resp.data), 7)
 
-        self.check_not_authenticated("get", url)
-
     def test_get_policy_check_status(self):
         # setup data
-        site = baker.make("clients.Site")
-        agent = baker.make_recipe("agents.agent", site=site)
-        policy = baker.make("automation.Policy")
+        agent = baker.make_recipe("agents.agent", site=self.site)
+        policy = self.policy
         policy_diskcheck = baker.make_recipe("checks.diskspace_check", policy=policy)
         managed_check = baker.make_recipe(
             "checks.diskspace_check",
@@ -198,64 +242,96 @@ class TestPolicyViews(TacticalTestCase):
 
         self.assertEqual(resp.status_code, 200)
         self.assertEqual(resp.data, serializer.data)
-        self.check_not_authenticated("patch", url)
 
     def test_policy_overview(self):
-        from clients.models import Client
-
         url = "/automation/policies/overview/"
 
-        policies = baker.make(
-            "automation.Policy", active=cycle([True, False]), _quantity=5
-        )
-        clients = baker.make(
-            "clients.Client",
-            server_policy=cycle(policies),
-            workstation_policy=cycle(policies),
-            _quantity=5,
-        )
-        baker.make(
-            "clients.Site",
-            client=cycle(clients),
-            server_policy=cycle(policies),
-            workstation_policy=cycle(policies),
-            _quantity=4,
-        )
-
-        baker.make("clients.Site", client=cycle(clients), _quantity=3)
-        resp = self.client.get(url, format="json")
+        policies = Policy.objects.bulk_create(
+            [Policy(name=f"Policy {i}", active=(i % 2 == 0)) for i in range(5)]
+        )
+        clients = Client.objects.bulk_create(
+            [
+                Client(
+                    name=f"Client {i}",
+                    server_policy=policies[i],
+                    workstation_policy=policies[i],
+                )
+                for i in range(5)
+            ]
+        )
+
+        # 4 sites with policies and 3 without
+        Site.objects.bulk_create(
+            [
+                Site(
+                    client=clients[i % len(clients)],
+                    name=f"Site {i}",
+                    server_policy=policies[i % len(policies)] if i < 4 else None,
+                    workstation_policy=policies[i % len(policies)] if i < 4 else None,
+                )
+                for i in range(7)
+            ]
+        )
+
+        with self.assertNumQueries(25):
+            resp = self.client.get(url)
         clients = Client.objects.all()
         serializer = PolicyOverviewSerializer(clients, many=True)
 
         self.assertEqual(resp.status_code, 200)
         self.assertEqual(resp.data, serializer.data)
 
-        self.check_not_authenticated("get", url)
-
     def test_get_related(self):
-        policy = baker.make("automation.Policy")
+        policy = self.policy
         url = f"/automation/policies/{policy.pk}/related/"
 
-        resp = self.client.get(url, format="json")
+        # 2 server and 2 workstation clients, each with 2 sites and an agent per site
+        mon_types = ["server", "server", "workstation", "workstation"]
+        clients = Client.objects.bulk_create(
+            [
+                Client(name=f"Client {i}", **{f"{mon_type}_policy": policy})
+                for i, mon_type in enumerate(mon_types)
+            ]
+        )
+        sites = Site.objects.bulk_create(
+            [
+                Site(client=client, name=f"Site {i}")
+                for client in clients
+                for i in range(2)
+            ]
+        )
+        Agent.objects.bulk_create(
+            [
+                Agent(
+                    site=site, hostname=f"Agent {i}", monitoring_type=mon_types[i // 2]
+                )
+                for i, site in enumerate(sites)
+            ]
+        )
+
+        # grows with every client, site and agent, so an added lookup shows up here
+        with self.assertNumQueries(40):
+            resp = self.client.get(url)
 
         self.assertEqual(resp.status_code, 200)
-        self.assertIsInstance(resp.data["server_clients"], list)
-        self.assertIsInstance(resp.data["workstation_clients"], list)
-        self.assertIsInstance(resp.data["server_sites"], list)
-        self.assertIsInstance(resp.data["workstation_sites"], list)
-        self.assertIsInstance(resp.data["agents"], list)
-
-        self.check_not_authenticated("get", url)
+        self.assertEqual(len(resp.data["server_clients"]), 2)
+        self.assertEqual(len(resp.data["workstation_clients"]), 2)
+        self.assertEqual(len(resp.data["server_sites"]), 4)
+        self.assertEqual(len(resp.data["workstation_sites"]), 4)
+        self.assertEqual(len(resp.data["agents"]), 8)
 
     def test_get_policy_task_status(self):
 
         # policy with a task
-        policy = baker.make("automation.Policy")
+        policy = self.policy
         task = baker.make("autotasks.AutomatedTask", policy=policy)
 
         # create policy managed tasks
         policy_tasks = baker.make(
-            "autotasks.AutomatedTask", parent_task=task.id, _quantity=5
+            "autotasks.AutomatedTask",
+            parent_task=task.id,
+            _quantity=5,
+            _bulk_create=True,
         )
 
         url = f"/automation/policyautomatedtaskstatus/{task.id}/task/"
@@ -266,25 +342,24 @@ class TestPolicyViews(TacticalTestCase):
         self.assertEqual(resp.data, serializer.data)
         self.assertEqual(len(resp.data), 5)
 
-        self.check_not_authenticated("patch", url)
-
-    @patch("automation.tasks.run_win_policy_autotask_task.delay")
-    def test_run_win_task(self, mock_task):
+    def test_run_win_task(self):
 
         # create managed policy tasks
-        tasks = baker.make(
+        baker.make(
             "autotasks.AutomatedTask",
             managed_by_policy=True,
             parent_task=1,
             _quantity=6,
+            _bulk_create=True,
+        )
+        task_pks = list(
+            AutomatedTask.objects.filter(parent_task=1).values_list("pk", flat=True)
         )
         url = "/automation/runwintask/1/"
         resp = self.client.put(url, format="json")
         self.assertEqual(resp.status_code, 200)
 
-        mock_task.assert_called_once_with([task.pk for task in tasks])
-
-        self.check_not_authenticated("put", url)
+        tasks.run_win_policy_autotask_task.delay.assert_called_once_with(task_pks)
 
     def test_create_new_patch_policy(self):
         url = "/automation/winupdatepolicy/"
@@ -294,7 +369,7 @@ class TestPolicyViews(TacticalTestCase):
         resp = self.client.post(url, data, format="json")
         self.assertEqual(resp.status_code, 404)
 
-        policy = baker.make("automation.Policy")
+        policy = self.policy
 
         data = {
             "policy": policy.pk,
@@ -313,15 +388,13 @@ class TestPolicyViews(TacticalTestCase):
         resp = self.client.post(url, data, format="json")
         self.assertEqual(resp.status_code, 200)
 
-        self.check_not_authenticated("post", url)
-
     def test_update_patch_policy(self):
 
         # test policy doesn't exist
         resp = self.client.put("/automation/winupdatepolicy/500/", format="json")
         self.assertEqual(resp.status_code, 404)
 
-        policy = baker.make("automation.Policy")
+        policy = self.policy
         patch_policy = baker.make("winupdate.WinUpdatePolicy", policy=policy)
         url = f"/automation/winupdatepolicy/{patch_policy.pk}/"
 
@@ -339,8 +412,6 @@ class TestPolicyViews(TacticalTestCase):
         resp = self.client.put(url, data, format="json")
         self.assertEqual(resp.status_code, 200)
 
-        self.check_not_authenticated("put", url)
-
     def test_reset_patch_policy(self):
         url = "/automation/winupdatepolicy/reset/"
 
@@ -355,105 +426,145 @@ class TestPolicyViews(TacticalTestCase):
             "reprocess_failed_inherit": True,
         }
 
-        clients = baker.make("clients.Client", _quantity=6)
-        sites = baker.make("clients.Site", client=cycle(clients), _quantity=10)
-        agents = baker.make_recipe(
-            "agents.agent",
-            site=cycle(sites),
-            _quantity=6,
+        clients = Client.objects.bulk_create(
+            [Client(name=f"Client {i}") for i in range(6)]
         )
-
-        # create patch policies
-        baker.make_recipe(
-            "winupdate.winupdate_approve", agent=cycle(agents), _quantity=6
+        sites = Site.objects.bulk_create(
+            [
+                Site(client=clients[i % len(clients)], name=f"Site {i}")
+                for i in range(10)
+            ]
+        )
+        agents = Agent.objects.bulk_create(
+            [Agent(site=site, monitoring_type="server") for site in sites[:6]]
         )
 
-        # test reset agents in site
-        data = {"site": sites[0].id}
-
-        resp = self.client.patch(url, data, format="json")
-        self.assertEqual(resp.status_code, 200)
-
-        agents = Agent.objects.filter(site=sites[0])
-
-        for agent in agents:
-            for k, v in inherit_fields.items():
-                self.assertEqual(getattr(agent.winupdatepolicy.get(), k), v)
-
-        # test reset agents in client
-        data = {"client": clients[1].id}
-
-        resp = self.client.patch(url, data, format="json")
-        self.assertEqual(resp.status_code, 200)
-
-        agents = Agent.objects.filter(site__client=clients[1])
-
-        for agent in agents:
-            for k, v in inherit_fields.items():
-                self.assertEqual(getattr(agent.winupdatepolicy.get(), k), v)
-
-        # test reset all agents
-        data = {}
-
-        resp = self.client.patch(url, data, format="json")
-        self.assertEqual(resp.status_code, 200)
-
-        agents = Agent.objects.all()
-        for agent in agents:
-            for k, v in inherit_fields.items():
-                self.assertEqual(getattr(agent.winupdatepolicy.get(), k), v)
-
-        self.check_not_authenticated("patch", url)
+        # create patch policies
+        WinUpdatePolicy.objects.bulk_create(
+            [
+                baker.prepare_recipe("winupdate.winupdate_approve", agent=agent)
+                for agent in agents
+            ]
+        )
+
+        # reset agents in a site, then in a client and then all agents
+        for data, agent_filter in (
+            ({"site": sites[0].id}, {"site": sites[0]}),
+            ({"client": clients[1].id}, {"site__client": clients[1]}),
+            ({}, {}),
+        ):
+            with self.subTest(data=data):
+                resp = self.client.patch(url, data, format="json")
+                self.assertEqual(resp.status_code, 200)
+
+                agents = Agent.objects.filter(**agent_filter).prefetch_related(
+                    "winupdatepolicy"
+                )
+                for agent in agents:
+                    winupdatepolicy = agent.winupdatepolicy.all()[0]
+                    for k, v in inherit_fields.items():
+                        self.assertEqual(getattr(winupdatepolicy, k), v)
 
     def test_delete_patch_policy(self):
         # test patch policy doesn't exist
-        resp = self.client.delete("/automation/winupdatepolicy/500/", format="json")
+        resp = self.client.delete("/automation/winupdatepolicy/500/")
         self.assertEqual(resp.status_code, 404)
 
         winupdate_policy = baker.make_recipe(
-            "winupdate.winupdate_policy", policy__name="Test Policy"
+            "winupdate.winupdate_policy", policy=self.policy
         )
         url = f"/automation/winupdatepolicy/{winupdate_policy.pk}/"
 
-        resp = self.client.delete(url, format="json")
+        resp = self.client.delete(url)
         self.assertEqual(resp.status_code, 200)
         self.assertFalse(
             WinUpdatePolicy.objects.filter(pk=winupdate_policy.pk).exists()
         )
 
-        self.check_not_authenticated("delete", url)
+
+class TestUnauthEndpoints(TacticalTestCase):
+    def test_not_authenticated(self):
+        endpoints = [
+            ("get", "/automation/policies/"),
+            ("post", "/automation/policies/"),
+            ("get", "/automation/policies/overview/"),
+            ("get", "/automation/policies/1/"),
+            ("put", "/automation/policies/1/"),
+            ("delete", "/automation/policies/1/"),
+            ("get", "/automation/policies/1/related/"),
+            ("get", "/automation/1/policychecks/"),
+            ("get", "/automation/1/policyautomatedtasks/"),
+            ("patch", "/automation/policycheckstatus/1/check/"),
+            ("patch", "/automation/policyautomatedtaskstatus/1/task/"),
+            ("put", "/automation/runwintask/1/"),
+            ("post", "/automation/winupdatepolicy/"),
+            ("put", "/automation/winupdatepolicy/1/"),
+            ("delete", "/automation/winupdatepolicy/1/"),
+            ("patch", "/automation/winupdatepolicy/reset/"),
+        ]
+
+        for method, url in endpoints:
+            with self.subTest(method=method, url=url):
+                self.check_not_authenticated(method, url)
 
 
 class TestPolicyTasks(TacticalTestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.setup_users()
+        cls.setup_coresettings()
+        cls.policy = baker.make("automation.Policy", active=True)
+        cls.policy_checks = cls.create_checks(policy=cls.policy)
+
+        # saving the agent generates its 7 checks from the policy
+        cls.agent = baker.make_recipe("agents.server_agent", policy=cls.policy)
+
     def setUp(self):
-        self.authenticate()
-        self.setup_coresettings()
+        reset_queued_tasks()
+        self.login()
+
+    def _make_tasks(self, policy=None, n=3, **overrides):
+        # inserts n tasks named Task1..Taskn with a single query
+        return AutomatedTask.objects.bulk_create(
+            [
+                AutomatedTask(policy=policy, name=f"Task{i + 1}", **overrides)
+                for i in range(n)
+            ]
+        )
+
+    def assert_all_check_counts(self, agent_ids, expected):
+        with self.assertNumQueries(1):
+            counts = check_counts(agent_ids)
+
+        self.assertEqual(counts, {pk: expected for pk in agent_ids})
 
     def test_policy_related(self):
 
         # Get Site and Client from an agent in list
-        clients = baker.make("clients.Client", _quantity=5)
-        sites = baker.make("clients.Site", client=cycle(clients), _quantity=25)
-        server_agents = baker.make_recipe(
-            "agents.server_agent",
-            site=cycle(sites),
-            _quantity=25,
+        clients = Client.objects.bulk_create(
+            [Client(name=f"Client {i}") for i in range(5)]
         )
-        workstation_agents = baker.make_recipe(
-            "agents.workstation_agent",
-            site=cycle(sites),
-            _quantity=25,
+        sites = Site.objects.bulk_create(
+            [
+                Site(client=clients[i % len(clients)], name=f"Site {i}")
+                for i in range(25)
+            ]
+        )
+        server_agents = Agent.objects.bulk_create(
+            [Agent(site=site, monitoring_type="server") for site in sites]
+        )
+        workstation_agents = Agent.objects.bulk_create(
+            [Agent(site=site, monitoring_type="workstation") for site in sites]
         )
 
+        # the class policy is already assigned to an agent
         policy = baker.make("automation.Policy", active=True)
 
         # Add Client to Policy
         policy.server_clients.add(server_agents[13].client)
         policy.workstation_clients.add(workstation_agents[15].client)
 
-        resp = self.client.get(
-            f"/automation/policies/{policy.pk}/related/", format="json"
-        )
+        resp = self.client.get(f"/automation/policies/{policy.pk}/related/")
 
         self.assertEqual(resp.status_code, 200)
         self.assertEquals(len(resp.data["server_clients"]), 1)
@@ -475,509 +586,322 @@ class TestPolicyTasks(TacticalTestCase):
         self.assertEquals(len(resp.data["agents"]), 10)
 
     def test_generating_agent_policy_checks(self):
-        from .tasks import generate_agent_checks_from_policies_task
 
         # setup data
-        policy = baker.make("automation.Policy", active=True)
-        checks = self.create_checks(policy=policy)
-        agent = baker.make_recipe("agents.agent", policy=policy)
+        policy = self.policy
+        agent = self.agent
 
         # test policy assigned to agent
-        generate_agent_checks_from_policies_task(policy.id)
+        tasks.generate_agent_checks_from_policies_task(policy.id)
 
         # make sure all checks were created. should be 7
-        agent_checks = Agent.objects.get(pk=agent.id).agentchecks.all()
+        agent_checks = list(agent.agentchecks.select_related("script"))
         self.assertEquals(len(agent_checks), 7)
 
+        # fields that should be copied from the policy check for each check type
+        copied_fields = {
+            "diskspace": ["disk", "error_threshold", "warning_threshold"],
+            "ping": ["ip"],
+            "cpuload": ["error_threshold", "warning_threshold"],
+            "memory": ["error_threshold", "warning_threshold"],
+            "winsvc": ["svc_name", "svc_display_name", "svc_policy_mode"],
+            "script": ["script"],
+            "eventlog": ["event_id", "event_type"],
+        }
+        policy_checks = {check.check_type: check for check in self.policy_checks}
+
         # make sure checks were copied correctly
         for check in agent_checks:
+            policy_check = policy_checks[check.check_type]
 
             self.assertTrue(check.managed_by_policy)
-            if check.check_type == "diskspace":
-                self.assertEqual(check.parent_check, checks[0].id)
-                self.assertEqual(check.disk, checks[0].disk)
-                self.assertEqual(check.error_threshold, checks[0].error_threshold)
-                self.assertEqual(check.warning_threshold, checks[0].warning_threshold)
-            elif check.check_type == "ping":
-                self.assertEqual(check.parent_check, checks[1].id)
-                self.assertEqual(check.ip, checks[1].ip)
-            elif check.check_type == "cpuload":
-                self.assertEqual(check.parent_check, checks[2].id)
-                self.assertEqual(check.error_threshold, checks[0].error_threshold)
-                self.assertEqual(check.warning_threshold, checks[0].warning_threshold)
-            elif check.check_type == "memory":
-                self.assertEqual(check.parent_check, checks[3].id)
-                self.assertEqual(check.error_threshold, checks[0].error_threshold)
-                self.assertEqual(check.warning_threshold, checks[0].warning_threshold)
-            elif check.check_type == "winsvc":
-                self.assertEqual(check.parent_check, checks[4].id)
-                self.assertEqual(check.svc_name, checks[4].svc_name)
-                self.assertEqual(check.svc_display_name, checks[4].svc_display_name)
-                self.assertEqual(check.svc_policy_mode, checks[4].svc_policy_mode)
-            elif check.check_type == "script":
-                self.assertEqual(check.parent_check, checks[5].id)
-                self.assertEqual(check.script, checks[5].script)
-            elif check.check_type == "eventlog":
-                self.assertEqual(check.parent_check, checks[6].id)
-                self.assertEqual(check.event_id, checks[6].event_id)
-                self.assertEqual(check.event_type, checks[6].event_type)
+            self.assertEqual(check.parent_check, policy_check.id)
+            for field in copied_fields[check.check_type]:
+                self.assertEqual(getattr(check, field), getattr(policy_check, field))
 
     def test_generating_agent_policy_checks_with_enforced(self):
-        from .tasks import generate_agent_checks_from_policies_task
 
         # setup data
         policy = baker.make("automation.Policy", active=True, enforced=True)
         script = baker.make_recipe("scripts.script")
         self.create_checks(policy=policy, script=script)
         site = baker.make("clients.Site")
-        agent = baker.make_recipe("agents.agent", site=site, policy=policy)
+        # the task under test generates the policy checks, not Agent.save
+        (agent,) = Agent.objects.bulk_create(
+            [baker.prepare_recipe("agents.agent", site=site, policy=policy)]
+        )
         self.create_checks(agent=agent, script=script)
 
-        generate_agent_checks_from_policies_task(policy.id, create_tasks=True)
+        tasks.generate_agent_checks_from_policies_task(policy.id, create_tasks=True)
 
         # make sure each agent check says overriden_by_policy
-        self.assertEqual(Agent.objects.get(pk=agent.id).agentchecks.count(), 14)
+        self.assertEqual(Check.objects.filter(agent_id=agent.id).count(), 14)
         self.assertEqual(
-            Agent.objects.get(pk=agent.id)
-            .agentchecks.filter(overriden_by_policy=True)
-            .count(),
+            Check.objects.filter(agent_id=agent.id, overriden_by_policy=True).count(),
             7,
         )
 
-    @patch("automation.tasks.generate_agent_checks_by_location_task.delay")
-    def test_generating_agent_policy_checks_by_location(
-        self, generate_agent_checks_by_location_task
-    ):
-        from automation.tasks import (
-            generate_agent_checks_by_location_task as generate_agent_checks,
-        )
+    def test_generating_agent_policy_checks_by_location(self):
 
         # setup data
-        policy = baker.make("automation.Policy", active=True)
-        self.create_checks(policy=policy)
+        policy = self.policy
 
-        baker.make(
-            "autotasks.AutomatedTask", policy=policy, name=seq("Task"), _quantity=3
-        )
-
-        server_agent = baker.make_recipe("agents.server_agent")
-        workstation_agent = baker.make_recipe("agents.workstation_agent")
+        self._make_tasks(policy)
 
-        # no checks should be preset on agents
-        self.assertEqual(Agent.objects.get(pk=server_agent.id).agentchecks.count(), 0)
-        self.assertEqual(
-            Agent.objects.get(pk=workstation_agent.id).agentchecks.count(), 0
+        # bulk create skips Agent.save, which would generate checks before any
+        # policy is assigned to their client or site
+        server_agent, workstation_agent = Agent.objects.bulk_create(
+            [
+                baker.prepare_recipe("agents.server_agent", _save_related=True),
+                baker.prepare_recipe("agents.workstation_agent", _save_related=True),
+            ]
         )
+        agent_ids = [server_agent.pk, workstation_agent.pk]
 
-        # set workstation policy on client and policy checks should be there
-        workstation_agent.client.workstation_policy = policy
-        workstation_agent.client.save()
-
-        # should trigger task in save method on core
-        generate_agent_checks_by_location_task.assert_called_with(
-            location={"site__client_id": workstation_agent.client.pk},
-            mon_type="workstation",
-            create_tasks=True,
-        )
-        generate_agent_checks_by_location_task.reset_mock()
-
-        generate_agent_checks(
-            location={"site__client_id": workstation_agent.client.pk},
-            mon_type="workstation",
-            create_tasks=True,
-        )
-
-        # make sure the checks were added
-        self.assertEqual(
-            Agent.objects.get(pk=workstation_agent.id).agentchecks.count(), 7
-        )
-        self.assertEqual(Agent.objects.get(pk=server_agent.id).agentchecks.count(), 0)
-
-        # remove workstation policy from client
-        workstation_agent.client.workstation_policy = None
-        workstation_agent.client.save()
-
-        # should trigger task in save method on core
-        generate_agent_checks_by_location_task.assert_called_with(
-            location={"site__client_id": workstation_agent.client.pk},
-            mon_type="workstation",
-            create_tasks=True,
-        )
-        generate_agent_checks_by_location_task.reset_mock()
-
-        generate_agent_checks(
-            location={"site__client_id": workstation_agent.client.pk},
-            mon_type="workstation",
-            create_tasks=True,
-        )
-
-        # make sure the checks were removed
-        self.assertEqual(
-            Agent.objects.get(pk=workstation_agent.id).agentchecks.count(), 0
-        )
-        self.assertEqual(Agent.objects.get(pk=server_agent.id).agentchecks.count(), 0)
-
-        # set server policy on client and policy checks should be there
-        server_agent.client.server_policy = policy
-        server_agent.client.save()
-
-        # should trigger task in save method on core
-        generate_agent_checks_by_location_task.assert_called_with(
-            location={"site__client_id": server_agent.client.pk},
-            mon_type="server",
-            create_tasks=True,
-        )
-        generate_agent_checks_by_location_task.reset_mock()
-
-        generate_agent_checks(
-            location={"site__client_id": server_agent.client.pk},
-            mon_type="server",
-            create_tasks=True,
-        )
-
-        # make sure checks were added
-        self.assertEqual(Agent.objects.get(pk=server_agent.id).agentchecks.count(), 7)
-        self.assertEqual(
-            Agent.objects.get(pk=workstation_agent.id).agentchecks.count(), 0
-        )
-
-        # remove server policy from client
-        server_agent.client.server_policy = None
-        server_agent.client.save()
-
-        # should trigger task in save method on core
-        generate_agent_checks_by_location_task.assert_called_with(
-            location={"site__client_id": server_agent.client.pk},
-            mon_type="server",
-            create_tasks=True,
-        )
-        generate_agent_checks_by_location_task.reset_mock()
-
-        generate_agent_checks(
-            location={"site__client_id": server_agent.client.pk},
-            mon_type="server",
-            create_tasks=True,
-        )
-
-        # make sure checks were removed
-        self.assertEqual(Agent.objects.get(pk=server_agent.id).agentchecks.count(), 0)
-        self.assertEqual(
-            Agent.objects.get(pk=workstation_agent.id).agentchecks.count(), 0
-        )
-
-        # set workstation policy on site and policy checks should be there
-        workstation_agent.site.workstation_policy = policy
-        workstation_agent.site.save()
-
-        # should trigger task in save method on core
-        generate_agent_checks_by_location_task.assert_called_with(
-            location={"site_id": workstation_agent.site.pk},
-            mon_type="workstation",
-            create_tasks=True,
-        )
-        generate_agent_checks_by_location_task.reset_mock()
-
-        generate_agent_checks(
-            location={"site_id": workstation_agent.site.pk},
-            mon_type="workstation",
-            create_tasks=True,
-        )
-
-        # make sure checks were added on workstation
-        self.assertEqual(
-            Agent.objects.get(pk=workstation_agent.id).agentchecks.count(), 7
-        )
-        self.assertEqual(Agent.objects.get(pk=server_agent.id).agentchecks.count(), 0)
-
-        # remove workstation policy from site
-        workstation_agent.site.workstation_policy = None
-        workstation_agent.site.save()
-
-        # should trigger task in save method on core
-        generate_agent_checks_by_location_task.assert_called_with(
-            location={"site_id": workstation_agent.site.pk},
-            mon_type="workstation",
-            create_tasks=True,
-        )
-        generate_agent_checks_by_location_task.reset_mock()
-
-        generate_agent_checks(
-            location={"site_id": workstation_agent.site.pk},
-            mon_type="workstation",
-            create_tasks=True,
-        )
-
-        # make sure checks were removed
-        self.assertEqual(
-            Agent.objects.get(pk=workstation_agent.id).agentchecks.count(), 0
-        )
-        self.assertEqual(Agent.objects.get(pk=server_agent.id).agentchecks.count(), 0)
-
-        # set server policy on site and policy checks should be there
-        server_agent.site.server_policy = policy
-        server_agent.site.save()
-
-        # should trigger task in save method on core
-        generate_agent_checks_by_location_task.assert_called_with(
-            location={"site_id": server_agent.site.pk},
-            mon_type="server",
-            create_tasks=True,
-        )
-        generate_agent_checks_by_location_task.reset_mock()
-
-        generate_agent_checks(
-            location={"site_id": server_agent.site.pk},
-            mon_type="server",
-            create_tasks=True,
-        )
-
-        # make sure checks were added
-        self.assertEqual(Agent.objects.get(pk=server_agent.id).agentchecks.count(), 7)
-        self.assertEqual(
-            Agent.objects.get(pk=workstation_agent.id).agentchecks.count(), 0
-        )
-
-        # remove server policy from site
-        server_agent.site.server_policy = None
-        server_agent.site.save()
-
-        # should trigger task in save method on core
-        generate_agent_checks_by_location_task.assert_called_with(
-            location={"site_id": server_agent.site.pk},
-            mon_type="server",
-            create_tasks=True,
-        )
-        generate_agent_checks_by_location_task.reset_mock()
-
-        generate_agent_checks(
-            location={"site_id": server_agent.site.pk},
-            mon_type="server",
-            create_tasks=True,
-        )
-
-        # make sure checks were removed
-        self.assertEqual(Agent.objects.get(pk=server_agent.id).agentchecks.count(), 0)
+        # no checks should be preset on agents
         self.assertEqual(
-            Agent.objects.get(pk=workstation_agent.id).agentchecks.count(), 0
-        )
-
-    @patch("automation.tasks.generate_all_agent_checks_task.delay")
-    def test_generating_policy_checks_for_all_agents(
-        self, generate_all_agent_checks_task
-    ):
-        from .tasks import generate_all_agent_checks_task as generate_all_checks
+            check_counts(agent_ids),
+            {server_agent.pk: 0, workstation_agent.pk: 0},
+        )
+
+        # set and then remove the policy on each client and site, the checks should
+        # only be added to the agent with the matching monitoring type
+        for agent, location, location_key in (
+            (workstation_agent, workstation_agent.client, "site__client_id"),
+            (server_agent, server_agent.client, "site__client_id"),
+            (workstation_agent, workstation_agent.site, "site_id"),
+            (server_agent, server_agent.site, "site_id"),
+        ):
+            mon_type = agent.monitoring_type
+            for location_policy, expected in ((policy, 7), (None, 0)):
+                with self.subTest(
+                    location=location_key,
+                    mon_type=mon_type,
+                    assigned=bool(location_policy),
+                ):
+                    setattr(location, f"{mon_type}_policy", location_policy)
+                    location.save()
+
+                    # should trigger task in save method on client or site
+                    tasks.generate_agent_checks_by_location_task.delay.assert_called_with(
+                        location={location_key: location.pk},
+                        mon_type=mon_type,
+                        create_tasks=True,
+                    )
+                    tasks.generate_agent_checks_by_location_task.delay.reset_mock()
+
+                    tasks.generate_agent_checks_by_location_task(
+                        location={location_key: location.pk},
+                        mon_type=mon_type,
+                        create_tasks=True,
+                    )
+
+                    # make sure the checks were added or removed
+                    expected_counts = {server_agent.pk: 0, workstation_agent.pk: 0}
+                    expected_counts[agent.pk] = expected
+                    self.assertEqual(check_counts(agent_ids), expected_counts)
+
+    def test_generating_policy_checks_for_all_agents(self):
         from core.models import CoreSettings
 
         # setup data
-        policy = baker.make("automation.Policy", active=True)
-        self.create_checks(policy=policy)
+        policy = self.policy
 
-        server_agents = baker.make_recipe("agents.server_agent", _quantity=3)
-        workstation_agents = baker.make_recipe("agents.workstation_agent", _quantity=4)
+        # no policy is assigned yet so there is nothing for Agent.save to generate
+        server_agents = baker.make_recipe(
+            "agents.server_agent", _quantity=3, _bulk_create=True
+        )
+        workstation_agents = baker.make_recipe(
+            "agents.workstation_agent", _quantity=4, _bulk_create=True
+        )
+        server_ids = [agent.pk for agent in server_agents]
+        workstation_ids = [agent.pk for agent in workstation_agents]
         core = CoreSettings.objects.first()
         core.server_policy = policy
         core.save()
 
-        generate_all_agent_checks_task.assert_called_with(
+        tasks.generate_all_agent_checks_task.delay.assert_called_with(
             mon_type="server", create_tasks=True
         )
-        generate_all_agent_checks_task.reset_mock()
-        generate_all_checks(mon_type="server", create_tasks=True)
+        tasks.generate_all_agent_checks_task.delay.reset_mock()
 
-        # all servers should have 7 checks
-        for agent in server_agents:
-            self.assertEqual(Agent.objects.get(pk=agent.id).agentchecks.count(), 7)
+        # the agents should be streamed rather than loaded all at once
+        with patch.object(
+            QuerySet, "iterator", autospec=True, side_effect=QuerySet.iterator
+        ) as iterator:
+            tasks.generate_all_agent_checks_task(mon_type="server", create_tasks=True)
+        iterator.assert_any_call(ANY, chunk_size=500)
 
-        for agent in workstation_agents:
-            self.assertEqual(Agent.objects.get(pk=agent.id).agentchecks.count(), 0)
+        # all servers should have 7 checks
+        self.assert_all_check_counts(server_ids, 7)
+        self.assert_all_check_counts(workstation_ids, 0)
 
         core.server_policy = None
         core.workstation_policy = policy
         core.save()
 
-        generate_all_agent_checks_task.assert_any_call(
+        tasks.generate_all_agent_checks_task.delay.assert_any_call(
             mon_type="workstation", create_tasks=True
         )
-        generate_all_agent_checks_task.assert_any_call(
+        tasks.generate_all_agent_checks_task.delay.assert_any_call(
             mon_type="server", create_tasks=True
         )
-        generate_all_agent_checks_task.reset_mock()
-        generate_all_checks(mon_type="server", create_tasks=True)
-        generate_all_checks(mon_type="workstation", create_tasks=True)
+        tasks.generate_all_agent_checks_task.delay.reset_mock()
+        tasks.generate_all_agent_checks_task(mon_type="server", create_tasks=True)
+        tasks.generate_all_agent_checks_task(mon_type="workstation", create_tasks=True)
 
         # all workstations should have 7 checks
-        for agent in server_agents:
-            self.assertEqual(Agent.objects.get(pk=agent.id).agentchecks.count(), 0)
-
-        for agent in workstation_agents:
-            self.assertEqual(Agent.objects.get(pk=agent.id).agentchecks.count(), 7)
+        self.assert_all_check_counts(server_ids, 0)
+        self.assert_all_check_counts(workstation_ids, 7)
 
         core.workstation_policy = None
         core.save()
 
-        generate_all_agent_checks_task.assert_called_with(
+        tasks.generate_all_agent_checks_task.delay.assert_called_with(
             mon_type="workstation", create_tasks=True
         )
-        generate_all_agent_checks_task.reset_mock()
-        generate_all_checks(mon_type="workstation", create_tasks=True)
+        tasks.generate_all_agent_checks_task.delay.reset_mock()
+        tasks.generate_all_agent_checks_task(mon_type="workstation", create_tasks=True)
 
         # nothing should have the checks
-        for agent in server_agents:
-            self.assertEqual(Agent.objects.get(pk=agent.id).agentchecks.count(), 0)
-
-        for agent in workstation_agents:
-            self.assertEqual(Agent.objects.get(pk=agent.id).agentchecks.count(), 0)
+        self.assert_all_check_counts(server_ids, 0)
+        self.assert_all_check_counts(workstation_ids, 0)
 
     def test_delete_policy_check(self):
-        from .tasks import delete_policy_check_task
-        from .models import Policy
 
-        policy = baker.make("automation.Policy", active=True)
-        self.create_checks(policy=policy)
-        agent = baker.make_recipe("agents.server_agent", policy=policy)
+        policy = self.policy
+        agent = self.agent
 
         # make sure agent has 7 checks
-        self.assertEqual(Agent.objects.get(pk=agent.id).agentchecks.count(), 7)
+        self.assert_all_check_counts([agent.pk], 7)
 
         # pick a policy check and delete it from the agent
-        policy_check_id = Policy.objects.get(pk=policy.id).policychecks.first().id
+        policy_check_id = (
+            Check.objects.filter(policy_id=policy.id)
+            .values_list("id", flat=True)
+            .first()
+        )
 
-        delete_policy_check_task(policy_check_id)
+        # the delete collects and clears the check's related rows before deleting
+        with self.assertNumQueries(6):
+            tasks.delete_policy_check_task(policy_check_id)
 
-        # make sure policy check doesn't exist on agent
-        self.assertEqual(Agent.objects.get(pk=agent.id).agentchecks.count(), 6)
-        self.assertFalse(
-            Agent.objects.get(pk=agent.id)
-            .agentchecks.filter(parent_check=policy_check_id)
-            .exists()
-        )
+            # make sure policy check doesn't exist on agent
+            self.assertFalse(
+                Check.objects.filter(
+                    agent_id=agent.id, parent_check=policy_check_id
+                ).exists()
+            )
 
-    def update_policy_check_fields(self):
-        from .tasks import update_policy_check_fields_task
-        from .models import Policy
+        self.assert_all_check_counts([agent.pk], 6)
 
-        policy = baker.make("automation.Policy", active=True)
-        self.create_checks(policy=policy)
-        agent = baker.make_recipe("agents.server_agent", policy=policy)
+    def test_update_policy_check_fields(self):
+
+        policy = self.policy
+        agent = self.agent
 
         # make sure agent has 7 checks
-        self.assertEqual(Agent.objects.get(pk=agent.id).agentchecks.count(), 7)
+        self.assert_all_check_counts([agent.pk], 7)
 
         # pick a policy check and update it with new values
-        ping_check = (
-            Policy.objects.get(pk=policy.id)
-            .policychecks.filter(check_type="ping")
-            .first()
-        )
+        ping_check = Check.objects.filter(
+            policy_id=policy.id, check_type="ping"
+        ).first()
         ping_check.ip = "12.12.12.12"
         ping_check.save()
 
-        update_policy_check_fields_task(ping_check.id)
+        tasks.update_policy_check_fields_task(ping_check.id)
 
         # make sure policy check was updated on the agent
         self.assertEquals(
-            Agent.objects.get(pk=agent.id)
-            .agentchecks.filter(parent_check=ping_check.id)
-            .ip,
+            Check.objects.filter(agent_id=agent.id, parent_check=ping_check.id)
+            .values("ip")
+            .first()["ip"],
             "12.12.12.12",
         )
 
     def test_generate_agent_tasks(self):
-        from .tasks import generate_agent_tasks_from_policies_task
 
         # create test data
-        policy = baker.make("automation.Policy", active=True)
-        tasks = baker.make(
-            "autotasks.AutomatedTask", policy=policy, name=seq("Task"), _quantity=3
-        )
-        agent = baker.make_recipe("agents.server_agent", policy=policy)
+        policy = self.policy
+        policy_tasks = self._make_tasks(policy)
+        agent = self.agent
 
-        generate_agent_tasks_from_policies_task(policy.id)
+        tasks.generate_agent_tasks_from_policies_task(policy.id)
 
-        agent_tasks = Agent.objects.get(pk=agent.id).autotasks.all()
+        agent_tasks = list(agent.autotasks.all())
+        at_by_parent = {task.parent_task: task for task in agent_tasks}
 
         # make sure there are 3 agent tasks
         self.assertEqual(len(agent_tasks), 3)
 
-        for task in agent_tasks:
-            self.assertTrue(task.managed_by_policy)
-            if task.name == "Task1":
-                self.assertEqual(task.parent_task, tasks[0].id)
-                self.assertEqual(task.name, tasks[0].name)
-            if task.name == "Task2":
-                self.assertEqual(task.parent_task, tasks[1].id)
-                self.assertEqual(task.name, tasks[1].name)
-            if task.name == "Task3":
-                self.assertEqual(task.parent_task, tasks[2].id)
-                self.assertEqual(task.name, tasks[2].name)
+        for i in range(3):
+            self.assertTrue(at_by_parent[policy_tasks[i].id].managed_by_policy)
+            self.assertEqual(
+                at_by_parent[policy_tasks[i].id].name, policy_tasks[i].name
+            )
 
     @patch("autotasks.tasks.delete_win_task_schedule.delay")
     def test_delete_policy_tasks(self, delete_win_task_schedule):
-        from .tasks import delete_policy_autotask_task
 
-        policy = baker.make("automation.Policy", active=True)
-        tasks = baker.make("autotasks.AutomatedTask", policy=policy, _quantity=3)
-        agent = baker.make_recipe("agents.server_agent", policy=policy)
+        policy = self.policy
+        policy_tasks = self._make_tasks(policy)
+        agent = self.agent
+        agent.generate_tasks_from_policies()
 
-        delete_policy_autotask_task(tasks[0].id)
+        at_by_parent = {task.parent_task: task for task in agent.autotasks.all()}
 
-        delete_win_task_schedule.assert_called_with(
-            agent.autotasks.get(parent_task=tasks[0].id).id
-        )
+        tasks.delete_policy_autotask_task(policy_tasks[0].id)
+
+        delete_win_task_schedule.assert_called_with(at_by_parent[policy_tasks[0].id].id)
 
     @patch("autotasks.tasks.run_win_task.delay")
     def test_run_policy_task(self, run_win_task):
-        from .tasks import run_win_policy_autotask_task
 
-        tasks = baker.make("autotasks.AutomatedTask", _quantity=3)
+        task_ids = [task.id for task in self._make_tasks()]
 
-        run_win_policy_autotask_task([task.id for task in tasks])
+        tasks.run_win_policy_autotask_task(task_ids)
 
-        run_win_task.side_effect = [task.id for task in tasks]
+        run_win_task.assert_has_calls([call(pk) for pk in task_ids], any_order=True)
         self.assertEqual(run_win_task.call_count, 3)
-        for task in tasks:
-            run_win_task.assert_any_call(task.id)
 
     @patch("autotasks.tasks.enable_or_disable_win_task.delay")
     def test_update_policy_tasks(self, enable_or_disable_win_task):
-        from .tasks import update_policy_task_fields_task
 
         # setup data
-        policy = baker.make("automation.Policy", active=True)
-        tasks = baker.make(
-            "autotasks.AutomatedTask", enabled=True, policy=policy, _quantity=3
-        )
-        agent = baker.make_recipe("agents.server_agent", policy=policy)
+        policy = self.policy
+        policy_tasks = self._make_tasks(policy, enabled=True)
+        agent = self.agent
+        agent.generate_tasks_from_policies()
 
-        tasks[0].enabled = False
-        tasks[0].save()
+        policy_tasks[0].enabled = False
+        policy_tasks[0].save()
 
-        update_policy_task_fields_task(tasks[0].id)
+        tasks.update_policy_task_fields_task(policy_tasks[0].id)
         enable_or_disable_win_task.assert_not_called()
 
-        self.assertFalse(agent.autotasks.get(parent_task=tasks[0].id).enabled)
+        at_by_parent = {task.parent_task: task for task in agent.autotasks.all()}
+        self.assertFalse(at_by_parent[policy_tasks[0].id].enabled)
 
-        update_policy_task_fields_task(tasks[0].id, update_agent=True)
+        tasks.update_policy_task_fields_task(policy_tasks[0].id, update_agent=True)
         enable_or_disable_win_task.assert_called_with(
-            agent.autotasks.get(parent_task=tasks[0].id).id, False
+            at_by_parent[policy_tasks[0].id].id, False
         )
 
     @patch("agents.models.Agent.generate_tasks_from_policies")
     @patch("agents.models.Agent.generate_checks_from_policies")
     def test_generate_agent_checks_with_agentpks(self, generate_checks, generate_tasks):
-        from automation.tasks import generate_agent_checks_task
-
-        agents = baker.make_recipe("agents.agent", _quantity=5)
 
-        # reset because creating agents triggers it
-        generate_checks.reset_mock()
-        generate_tasks.reset_mock()
+        # the task looks the agents up by pk so they have to exist, but bulk
+        # creating them skips Agent.save and the generate calls it makes
+        agents = baker.make_recipe("agents.agent", _quantity=5, _bulk_create=True)
+        agent_pks = [agent.pk for agent in agents]
 
-        generate_agent_checks_task([agent.pk for agent in agents])
-        self.assertEquals(generate_checks.call_count, 5)
-        generate_tasks.assert_not_called()
-        generate_checks.reset_mock()
+        for create_tasks in (False, True):
+            with self.subTest(create_tasks=create_tasks):
+                tasks.generate_agent_checks_task(agent_pks, create_tasks=create_tasks)
+                self.assertEquals(generate_checks.call_count, 5)
+                self.assertEquals(generate_tasks.call_count, 5 if create_tasks else 0)
 
-        generate_agent_checks_task([agent.pk for agent in agents], create_tasks=True)
-        self.assertEquals(generate_checks.call_count, 5)
-        self.assertEquals(generate_checks.call_count, 5)
+                for mock in (generate_checks, generate_tasks):
+                    mock.reset_mock()
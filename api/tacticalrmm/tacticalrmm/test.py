@@ -1,21 +1,34 @@
+from http.cookies import SimpleCookie
+
 from django.test import TestCase, override_settings
 from model_bakery import baker
 
 from rest_framework.test import APIClient
 
 from accounts.models import User
+from checks.models import Check
 from core.models import CoreSettings
 from rest_framework.authtoken.models import Token
 
 
 class TacticalTestCase(TestCase):
+    client_class = APIClient
+
     def authenticate(self):
-        self.john = User(username="john")
-        self.john.set_password("hunter2")
-        self.john.save()
-        self.alice = User(username="alice")
-        self.alice.set_password("hunter2")
-        self.alice.save()
+        self.setup_users()
+        self.login()
+
+    # can be called from setUpTestData so the users are only created once per class
+    @classmethod
+    def setup_users(cls):
+        cls.john = User(username="john")
+        cls.john.set_password("hunter2")
+        cls.john.save()
+        cls.alice = User(username="alice")
+        cls.alice.set_password("hunter2")
+        cls.alice.save()
+
+    def login(self):
         self.client_setup()
         self.client.force_authenticate(user=self.john)
 
@@ -26,28 +39,26 @@ class TacticalTestCase(TestCase):
         Token.objects.create(user=agent_user)
 
     def client_setup(self):
-        self.client = APIClient()
+        # reset auth state in memory, logout() would query the session table
+        self.client.cookies = SimpleCookie()
+        self.client.credentials()
+        self.client.force_authenticate(None)
 
     # fixes tests waiting 2 minutes for mesh token to appear
+    @classmethod
     @override_settings(
         MESH_TOKEN_KEY="41410834b8bb4481446027f87d88ec6f119eb9aa97860366440b778540c7399613f7cabfef4f1aa5c0bd9beae03757e17b2e990e5876b0d9924da59bdf24d3437b3ed1a8593b78d65a72a76c794160d9"
     )
-    def setup_coresettings(self):
-        self.coresettings = CoreSettings.objects.create()
+    def setup_coresettings(cls):
+        cls.coresettings = CoreSettings.objects.create()
 
     def check_not_authenticated(self, method, url):
-        self.client.logout()
-        switch = {
-            "get": self.client.get(url),
-            "post": self.client.post(url),
-            "put": self.client.put(url),
-            "patch": self.client.patch(url),
-            "delete": self.client.delete(url),
-        }
-        r = switch.get(method)
+        self.client_setup()
+        r = getattr(self.client, method)(url)
         self.assertEqual(r.status_code, 401)
 
-    def create_checks(self, policy=None, agent=None, script=None):
+    @classmethod
+    def create_checks(cls, policy=None, agent=None, script=None):
 
         if not policy and not agent:
             return
@@ -66,9 +77,21 @@ class TacticalTestCase(TestCase):
         checks = list()
         for recipe in check_recipes:
             if not script:
-                checks.append(baker.make_recipe(recipe, policy=policy, agent=agent))
+                checks.append(
+                    baker.prepare_recipe(
+                        recipe, policy=policy, agent=agent, _save_related=True
+                    )
+                )
             else:
                 checks.append(
-                    baker.make_recipe(recipe, policy=policy, agent=agent, script=script)
+                    baker.prepare_recipe(
+                        recipe,
+                        policy=policy,
+                        agent=agent,
+                        script=script,
+                        _save_related=True,
+                    )
                 )
-        return checks
+
+        # insert all of the checks with a single query
+        return Check.objects.bulk_create(checks)